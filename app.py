@@ -1,28 +1,114 @@
 import os
+from datetime import datetime, timezone
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError, TimeoutError
 
-from models import setup_db, Club, Player
+from models import setup_db, use_replica, statement_timeout, read_engine, sync_horizon, db, Club, Player, Tombstone
 from auth import AuthError, requires_auth
+from coalesce import coalesce
+from compress import init_compression
+import events
+import export
+import ingest
+import leaderboards
+import metrics
+import transfers
+from slowlog import init_slow_query_log
+
+'''
+Seconds clients are asked to wait (Retry-After) when the database is unavailable
+'''
+DB_RETRY_AFTER = int(os.getenv('DB_RETRY_AFTER', '1'))
+
+'''
+Statement budget of the single row lookups, in milliseconds
+'''
+DB_LOOKUP_TIMEOUT_MS = int(os.getenv('DB_LOOKUP_TIMEOUT_MS', '1000'))
+
+'''
+Returns the fields requested with ?fields=a,b in model order,
+every field when the parameter is missing
+aborts with 400 on a field the model does not have
+'''
+def requested_fields(allowed):
+  fields = request.args.get('fields')
+  if fields is None:
+    return allowed
+
+  requested = set(f.strip() for f in fields.split(',') if f.strip())
+  if not requested or not requested.issubset(allowed):
+    abort(400)
+  return tuple(f for f in allowed if f in requested)
+
+'''
+Returns the ?since= of a delta sync, None when the parameter is missing:
+a watermark returned by an earlier sync (an int), or a time (ISO 8601,
+UTC when no offset is given) as naive UTC
+aborts with 400 when it is malformed
+'''
+def requested_since():
+  since = request.args.get('since')
+  if since is None:
+    return None
+  if since.strip().isdigit():
+    return int(since)
+
+  try:
+    # an unescaped '+' of the offset arrives as a space
+    since = datetime.fromisoformat(since.strip().replace(' ', '+').replace('Z', '+00:00'))
+  except ValueError:
+    abort(400)
+  if since.tzinfo is not None:
+    since = since.astimezone(timezone.utc).replace(tzinfo=None)
+  return since
+
+'''
+Returns the watermark of a delta sync, read before its rows: the
+changes committed after it are all at or above it (see sync_horizon)
+'''
+def sync_watermark():
+  return str(db.session.execute(select(sync_horizon())).scalar())
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
   setup_db(app)
   CORS(app)
+  init_compression(app)
+  init_slow_query_log(app)
 
   '''
   Handling GET requests to fetch 
   all available clubs
   This endpoint should return a list of clubs, 
   number of total clubs
+  ?fields= limits the returned (and queried) club fields
+  ?since= only returns the clubs changed and the ids of the clubs
+  deleted after that time, with the watermark to pass to the next sync
   '''
   @app.route("/clubs")
   @requires_auth("get:clubs")
+  @coalesce()
+  @use_replica
   def retrieve_clubs(self):
-    clubs = Club.query.all()
-    club_list = []
+    since = requested_since()
+    # read before the rows, and only by delta syncs
+    watermark = sync_watermark() if since is not None else None
+    clubs = Club.select(requested_fields(Club.FIELDS), since=since)
+
+    if since is not None:
+      return jsonify(
+        {
+          "success": True,
+          "clubs": clubs,
+          "deleted": Tombstone.deleted_since(Club.__tablename__, since),
+          "total_clubs": len(clubs),
+          "watermark": watermark
+        }
+      )
 
     if len(clubs) == 0:
       return jsonify(
@@ -32,33 +118,63 @@ def create_app(test_config=None):
         }
       )
 
-    '''
-    adding a list of player names to each club
-    '''
-    for club in clubs:
-      players = Player.query.filter(Player.club_id==club.id).all()
-      club_dic = club.format()
-      club_dic['players'] = [p.name for p in players]
-      club_list.append(club_dic)
-
     return jsonify(
       {
         "success": True,
-        "clubs": club_list,
+        "clubs": clubs,
         "total_clubs": len(clubs)
       }
     )
 
+  '''
+  Handling GET requests for a single club
+  ?fields= limits the returned (and queried) club fields
+  '''
+  @app.route("/clubs/<int:club_id>")
+  @requires_auth("get:clubs")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
+  @use_replica
+  def retrieve_club(self, club_id):
+    clubs = Club.select(requested_fields(Club.FIELDS), club_id)
+
+    if len(clubs) == 0:
+      abort(404)
+
+    return jsonify(
+      {
+        "success": True,
+        "club": clubs[0]
+      }
+    )
+
   '''
   Handling GET requests for players
   This endpoint should return a list of players, 
   number of total players
+  ?fields= limits the returned (and queried) player fields
+  ?since= only returns the players changed and the ids of the players
+  deleted after that time, with the watermark to pass to the next sync
   '''
   @app.route("/players")
   @requires_auth("get:players")
+  @coalesce()
+  @use_replica
   def retrieve_players(self):
-    players = Player.query.all()
-    player_list = []
+    since = requested_since()
+    # read before the rows, and only by delta syncs
+    watermark = sync_watermark() if since is not None else None
+    players = Player.select(requested_fields(Player.FIELDS), since=since)
+
+    if since is not None:
+      return jsonify(
+        {
+          "success": True,
+          "players": players,
+          "deleted": Tombstone.deleted_since(Player.__tablename__, since),
+          "total_players": len(players),
+          "watermark": watermark
+        }
+      )
 
     if len(players) == 0:
       return jsonify(
@@ -68,23 +184,79 @@ def create_app(test_config=None):
         }
       )
 
-    '''
-    adding club name to each player
-    '''
-    for player in players:
-      club = Club.query.filter(Club.id==player.club_id).one_or_none()
-      player_dic = player.format()
-      player_dic["club_name"] = club.name
-      player_list.append(player_dic)
-
     return jsonify(
       {
         "success": True,
-        "players": player_list,
+        "players": players,
         "total_players": len(players)
       }
     )
 
+  '''
+  Handling GET requests for a single player
+  ?fields= limits the returned (and queried) player fields
+  '''
+  @app.route("/players/<int:player_id>")
+  @requires_auth("get:players")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
+  @use_replica
+  def retrieve_player(self, player_id):
+    players = Player.select(requested_fields(Player.FIELDS), player_id)
+
+    if len(players) == 0:
+      abort(404)
+
+    return jsonify(
+      {
+        "success": True,
+        "player": players[0]
+      }
+    )
+
+  '''
+  Handling GET requests for the most valuable players,
+  overall and per club category
+  ?category= only returns the leaderboard of that category
+  ?limit= players per leaderboard, 10 by default
+  ranked on the primary, not a replica: the results are cached until
+  the next write, a lagging replica would keep a stale ranking cached
+  '''
+  @app.route("/leaderboards/players")
+  @requires_auth("get:players")
+  @coalesce()
+  def retrieve_player_leaderboards(self):
+    category = request.args.get('category')
+    limit = request.args.get('limit', 10)
+
+    try:
+      limit = int(limit)
+    except ValueError:
+      abort(400)
+    if limit < 1 or limit > leaderboards.LEADERBOARD_MAX_LIMIT:
+      abort(400)
+
+    return jsonify(
+      {
+        "success": True,
+        "leaderboards": leaderboards.most_valuable_players(category, limit)
+      }
+    )
+
+  '''
+  Endpoint to GET every player joined with its club as CSV,
+  streamed from the database in constant memory, 503 while
+  EXPORT_MAX_STREAMS exports are running
+  '''
+  @app.route("/export/players.csv")
+  @requires_auth("get:players")
+  def export_players(self):
+    engine = read_engine() or db.get_engine()
+
+    try:
+      return export.stream(engine)
+    except export.ExportUnavailable:
+      abort(503)
+
   '''
   Endpoint to POST a new club, 
   which will require club name, category and asset
@@ -108,6 +280,8 @@ def create_app(test_config=None):
           "club": new_club.format()
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
     except:
       abort(422)
 
@@ -134,17 +308,66 @@ def create_app(test_config=None):
           "player": new_player.format()
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
     except:
       abort(422)
 
+  '''
+  Endpoints to POST many clubs or players at once, as a JSON array
+  or as CSV with a header row (Content-Type: text/csv),
+  either every record is imported or none is
+    returns the number imported, or the errors of the invalid records
+  '''
+  @app.route("/clubs/import", methods=["POST"])
+  @requires_auth("post:clubs")
+  def import_clubs(self):
+    return import_records("clubs")
+
+  @app.route("/players/import", methods=["POST"])
+  @requires_auth("post:players")
+  def import_players(self):
+    return import_records("players")
+
+  def import_records(kind):
+    if request.mimetype == "text/csv":
+      records = ingest.iter_csv(request.stream)
+    elif request.mimetype == "application/json":
+      records = ingest.iter_json_array(request.stream)
+    else:
+      abort(400)
+
+    try:
+      imported, errors = ingest.ingest(kind, records)
+    except ingest.MalformedPayload:
+      abort(400)
+
+    if errors:
+      return jsonify(
+        {
+          "success": False,
+          "error": 422,
+          "message": "unprocessable",
+          "errors": errors
+        }
+      ), 422
+
+    return jsonify(
+      {
+        "success": True,
+        "imported": imported
+      }
+    )
+
   '''
   Endpoint to EDIT a club, 
     returns the updated club info.
   '''
   @app.route("/clubs/<int:club_id>", methods=["PATCH"])
   @requires_auth("patch:clubs")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
   def update_clubs(self, club_id):
-    club = Club.query.filter(Club.id==club_id).one_or_none()
+    club = Club.get(club_id)
 
     if club is None:
       abort(404)
@@ -162,6 +385,8 @@ def create_app(test_config=None):
           "clubs": club.format()
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
     except:
       abort(422)
 
@@ -171,8 +396,9 @@ def create_app(test_config=None):
   '''
   @app.route("/players/<int:player_id>", methods=["PATCH"])
   @requires_auth("patch:players")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
   def update_players(self, player_id):
-    player = Player.query.filter(Player.id==player_id).one_or_none()
+    player = Player.get(player_id)
 
     if player is None:
       abort(404)
@@ -190,7 +416,39 @@ def create_app(test_config=None):
           "players": player.format()
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
+    except:
+      abort(422)
+
+  '''
+  Endpoint to move many players between clubs at once,
+  which will require a list of player ID and target club ID,
+    returns the outcome of every move.
+  '''
+  @app.route("/transfers", methods=["POST"])
+  @requires_auth("patch:players")
+  def create_transfers(self):
+    body = request.get_json(silent=True)
+    moves = body.get('transfers') if isinstance(body, dict) else body
+
+    if not isinstance(moves, list) or len(moves) == 0 or len(moves) > transfers.TRANSFERS_MAX:
+      abort(422)
+
+    try:
+      outcomes = transfers.transfer_players(moves)
+
+      return jsonify(
+        {
+          "success": True,
+          "transfers": outcomes,
+          "total_transferred": sum(1 for o in outcomes if o["status"] == transfers.TRANSFERRED)
+        }
+      )
+    except (OperationalError, TimeoutError):
+      raise
     except:
+      db.session.rollback()
       abort(422)
 
   '''
@@ -198,8 +456,9 @@ def create_app(test_config=None):
   '''
   @app.route("/clubs/<int:club_id>", methods=["DELETE"])
   @requires_auth("delete:clubs")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
   def delete_clubs(self, club_id):
-    club = Club.query.filter(Club.id==club_id).one_or_none()
+    club = Club.get(club_id)
 
     if club is None:
       abort(404)
@@ -212,6 +471,8 @@ def create_app(test_config=None):
           "deleted": club.id
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
     except:
       abort(422)
 
@@ -220,8 +481,9 @@ def create_app(test_config=None):
   '''
   @app.route("/players/<int:player_id>", methods=["DELETE"])
   @requires_auth("delete:players")
+  @statement_timeout(DB_LOOKUP_TIMEOUT_MS)
   def delete_players(self, player_id):
-    player = Player.query.filter(Player.id==player_id).one_or_none()
+    player = Player.get(player_id)
 
     if player is None:
       abort(404)
@@ -234,9 +496,44 @@ def create_app(test_config=None):
           "deleted": player.id
         }
       )
+    except (OperationalError, TimeoutError):
+      raise
     except:
       abort(422)
 
+  '''
+  Server-sent events stream of player signings and transfers
+  resumes after the Last-Event-ID header (or ?last_event_id=)
+  '''
+  @app.route("/events")
+  @requires_auth("get:players")
+  def stream_events(self):
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+
+    try:
+      last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+      abort(400)
+
+    try:
+      return events.stream(last_event_id)
+    except events.EventsUnavailable:
+      abort(503)
+
+  '''
+  Endpoint to GET the in-process counters,
+  e.g. how many list requests were coalesced
+  '''
+  @app.route("/metrics")
+  @requires_auth("get:metrics")
+  def retrieve_metrics(self):
+    return jsonify(
+      {
+        "success": True,
+        "metrics": metrics.snapshot()
+      }
+    )
+
   # Error Handling
   '''
   Error handling for bad request
@@ -282,6 +579,20 @@ def create_app(test_config=None):
           "message": "internal server error"
       }), 500
 
+  '''
+  Error handler for services that are unavailable for now
+  '''
+  @app.errorhandler(503)
+  def service_unavailable(error):
+      response = jsonify({
+          "success": False,
+          "error": 503,
+          "message": "service unavailable"
+      })
+      response.status_code = 503
+      response.headers["Retry-After"] = str(DB_RETRY_AFTER)
+      return response
+
   '''
   Error handler for AuthError Exceptions
   A standardized way to communicate auth failure modes
@@ -290,11 +601,40 @@ def create_app(test_config=None):
   def unauthorized(ex):
       response = jsonify(ex.error)
       response.status_code = ex.status_code
+      response.headers.extend(ex.headers)
+      return response
+
+  '''
+  Error handler for statements cancelled by their timeout,
+  unreachable databases and an exhausted connection pool
+  '''
+  @app.errorhandler(OperationalError)
+  @app.errorhandler(TimeoutError)
+  def database_unavailable(error):
+      db.session.rollback()
+      metrics.incr('db_unavailable')
+      response = jsonify({
+          "success": False,
+          "error": 503,
+          "message": "service unavailable"
+      })
+      response.status_code = 503
+      response.headers["Retry-After"] = str(DB_RETRY_AFTER)
       return response
 
   return app
 
-APP = create_app()
+'''
+APP, the application served by gunicorn (app:APP), is created on
+first access: the ingest validation processes are spawned and
+re-import the main script, they must not build an application
+'''
+def __getattr__(name):
+  global APP
+  if name == 'APP':
+    APP = create_app()
+    return APP
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 if __name__ == '__main__':
-    APP.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
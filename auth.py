@@ -1,22 +1,46 @@
-import json, os
-from flask import request, _request_ctx_stack
+import json, math, os, threading, time
+from flask import g, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from breaker import CircuitBreaker, CircuitOpenError
+from limits import LimitExceeded, limiter
+
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN', 'fsnd3469.us.auth0.com')
 API_AUDIENCE = os.getenv('API_AUDIENCE', 'agency')
 ALGORITHMS = [os.getenv('ALGORITHMS', 'RS256')]
 
+'''
+JWKS retrieval settings
+    JWKS_TIMEOUT: seconds to wait for Auth0
+    JWKS_CACHE_TTL: seconds the signing keys are reused before refetching
+    JWKS_MIN_REFRESH: minimum seconds between refetches for an unknown key id
+    JWKS_BREAKER_FAILURES / JWKS_BREAKER_RESET: circuit breaker thresholds,
+    cached keys keep being served while the circuit is open
+'''
+JWKS_TIMEOUT = float(os.getenv('JWKS_TIMEOUT', '3'))
+JWKS_CACHE_TTL = float(os.getenv('JWKS_CACHE_TTL', '600'))
+JWKS_MIN_REFRESH = float(os.getenv('JWKS_MIN_REFRESH', '30'))
+
+jwks_breaker = CircuitBreaker(
+    'jwks',
+    failure_threshold=int(os.getenv('JWKS_BREAKER_FAILURES', '3')),
+    reset_timeout=float(os.getenv('JWKS_BREAKER_RESET', '30'))
+)
+_jwks_lock = threading.Lock()
+_jwks_cache = {'jwks': None, 'fetched': 0.0}
+
 ## AuthError Exception
 '''
 AuthError Exception
 A standardized way to communicate auth failure modes
 '''
 class AuthError(Exception):
-    def __init__(self, error, status_code):
+    def __init__(self, error, status_code, headers=None):
         self.error = error
         self.status_code = status_code
+        self.headers = headers or {}
 
 
 ## Auth Header
@@ -82,12 +106,46 @@ def check_permissions(permission, payload):
         }, 403)
     return True
 
+'''
+@INPUTS
+    refresh: refetch the keys even though the cache is fresh (i.e. unknown key id)
+
+returns the Auth0 /.well-known/jwks.json, cached for JWKS_CACHE_TTL seconds
+serves the cached keys when Auth0 fails or its circuit is open
+raises an AuthError (503) when there are no keys to fall back to
+'''
+def get_jwks(refresh=False):
+    with _jwks_lock:
+        jwks, fetched = _jwks_cache['jwks'], _jwks_cache['fetched']
+    age = time.monotonic() - fetched
+    if jwks is not None and (age < JWKS_CACHE_TTL and not refresh or age < JWKS_MIN_REFRESH):
+        return jwks
+
+    try:
+        jwks = jwks_breaker.call(fetch_jwks)
+    except Exception as e:
+        if jwks is not None:
+            return jwks
+        retry_after = e.retry_after if isinstance(e, CircuitOpenError) else jwks_breaker.reset_timeout
+        raise AuthError({
+            'code': 'auth_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503, {'Retry-After': str(int(retry_after))})
+
+    with _jwks_lock:
+        _jwks_cache['jwks'], _jwks_cache['fetched'] = jwks, time.monotonic()
+    return jwks
+
+def fetch_jwks():
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json', timeout=JWKS_TIMEOUT)
+    return json.loads(jsonurl.read())
+
 '''
 @INPUTS
     token: a json web token (string)
 
 it is an Auth0 token with key id (kid)
-it verifys the token using Auth0 /.well-known/jwks.json
+it verifys the token using Auth0 /.well-known/jwks.json (see get_jwks)
 it decodes the payload from the token
 it validates the claims
 return the decoded payload
@@ -95,8 +153,6 @@ return the decoded payload
 !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -105,6 +161,11 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    jwks = get_jwks()
+    if not any(key['kid'] == unverified_header['kid'] for key in jwks['keys']):
+        # the keys may have been rotated since they were cached
+        jwks = get_jwks(refresh=True)
+
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -155,6 +216,8 @@ requires_auth(permission) decorator method
 it uses the get_token_auth_header method to get the token
 it uses the verify_decode_jwt method to decode the jwt
 it uses the check_permissions method validate claims and check the requested permission
+it sheds the request with a 429 when the token subject is over its rate or
+concurrency limits (see limits.py), before the decorated method does any work
 return the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
@@ -164,6 +227,14 @@ def requires_auth(permission=''):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            g.subject = payload.get('sub')
+            try:
+                with limiter.limit(payload.get('sub', ''), permission):
+                    return f(payload, *args, **kwargs)
+            except LimitExceeded as e:
+                raise AuthError({
+                    'code': 'too_many_requests',
+                    'description': 'Too many requests, %s limit exceeded.' % e.reason
+                }, 429, {'Retry-After': str(max(1, math.ceil(e.retry_after)))})
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import metrics
+
+'''
+CircuitOpenError Exception
+Raised instead of calling a dependency whose circuit is open
+'''
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        Exception.__init__(self, '%s circuit is open' % name)
+        self.retry_after = retry_after
+
+'''
+CircuitBreaker
+    closed: calls go through, failure_threshold failures in a row open it
+    open: calls are refused until reset_timeout seconds have passed
+    half_open: a single trial call decides between closed and open
+
+its state is exposed as the <name>_breaker_state metric
+'''
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        metrics.register_gauge('%s_breaker_state' % name, lambda: self.state)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    '''
+    Raises CircuitOpenError unless a call may go through now
+    '''
+    def before_call(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            waited = time.monotonic() - self._opened_at
+            if self._state == self.OPEN and waited >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(self.name, max(1, int(self.reset_timeout - waited)))
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        metrics.incr('%s_breaker_failures' % self.name)
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    '''
+    call(fn)
+        calls fn through the breaker, recording its outcome
+    '''
+    def call(self, fn, *args, **kwargs):
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import event
+
+import metrics
+from models import RoutingSession, wrote_recently
+
+'''
+Seconds a coalesced result may still be served after its query finished,
+0 only shares the results of queries that are in flight
+'''
+COALESCE_FRESHNESS = float(os.getenv('COALESCE_FRESHNESS', '0'))
+
+_lock = threading.Lock()
+_inflight = {}
+_fresh = {}
+_generation = [0]
+
+class _Call:
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+'''
+coalesce(freshness) decorator method
+@INPUTS
+    freshness: seconds a finished result stays shareable
+
+Concurrent requests for the same route, query parameters and permission
+scope share a single execution of the view and its encoded body.
+The decorated view receives the decoded jwt payload, so it has
+to be placed directly below requires_auth.
+A client that wrote within REPLICA_STICKY_SECONDS runs the view on its
+own, a shared result may predate its write.
+'''
+def coalesce(freshness=None):
+    def coalesce_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            ttl = COALESCE_FRESHNESS if freshness is None else freshness
+            if wrote_recently():
+                metrics.incr('coalesce_bypassed')
+                return f(payload, *args, **kwargs)
+            key = (
+                request.path,
+                tuple(sorted(request.args.items(multi=True))),
+                tuple(sorted(payload.get('permissions', [])))
+            )
+
+            with _lock:
+                fresh = _fresh.get(key) if ttl else None
+                if fresh is not None and fresh[0] > time.monotonic():
+                    metrics.incr('coalesce_fresh_hits')
+                    return _build(fresh[1])
+                call = _inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = _inflight[key] = _Call(_generation[0])
+
+            if not leader:
+                call.done.wait()
+                metrics.incr('coalesce_followers')
+                if call.error is not None:
+                    raise call.error
+                return _build(call.result)
+
+            metrics.incr('coalesce_leaders')
+            try:
+                response = current_app.make_response(f(payload, *args, **kwargs))
+                call.result = (response.get_data(), response.status_code,
+                               list(response.headers))
+                return response
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with _lock:
+                    if _inflight.get(key) is call:
+                        del _inflight[key]
+                    # a write committed while the view ran has made the result stale
+                    if ttl and call.result is not None and call.result[1] == 200 \
+                            and call.generation == _generation[0]:
+                        _prune()
+                        _fresh[key] = (time.monotonic() + ttl, call.result)
+                call.done.set()
+        return wrapper
+    return coalesce_decorator
+
+def _build(result):
+    body, status, headers = result
+    return current_app.response_class(body, status=status, headers=headers)
+
+def _prune():
+    now = time.monotonic()
+    for key in [key for key, (expires, _) in _fresh.items() if expires <= now]:
+        del _fresh[key]
+
+'''
+Drops every finished result once a write is committed, the calls in
+flight keep their followers but take no new ones
+'''
+@event.listens_for(RoutingSession, 'after_commit')
+def invalidate(session=None):
+    with _lock:
+        _generation[0] += 1
+        _fresh.clear()
+        _inflight.clear()
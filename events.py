@@ -0,0 +1,291 @@
+import itertools
+import json
+import os
+import queue
+import select as _select
+import threading
+import time
+from collections import deque
+from flask import Response, current_app
+from sqlalchemy import JSON, Sequence, Text, cast, column, event, func, inspect, select, text, values
+
+import metrics
+from models import db, RoutingSession, Player
+
+'''
+Change feed settings
+    EVENTS_BACKLOG: events kept per process for resumption by id
+    EVENTS_HEARTBEAT: seconds between keepalive comments on idle streams
+    EVENTS_QUEUE_SIZE: events buffered per subscriber before it is dropped
+    EVENTS_MAX_STREAMS: streams open at once per process, every stream holds
+    a server thread (8 per gthread worker, see Procfile), more are refused
+'''
+EVENTS_CHANNEL = 'agency_events'
+EVENTS_BACKLOG = int(os.getenv('EVENTS_BACKLOG', '1000'))
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '1000'))
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', '4'))
+EVENTS_LISTEN_TIMEOUT = 5
+
+_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+# event ids are shared by every process through a database sequence,
+# the in-memory fallback (SQLite/testing) counts per process instead
+event_id_seq = Sequence('agency_events_id_seq', metadata=db.metadata)
+_memory_ids = itertools.count(1)
+_memory_last = [0]
+
+'''
+EventsUnavailable Exception
+Raised instead of opening a stream the feed cannot serve now
+'''
+class EventsUnavailable(Exception):
+    pass
+
+class _Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.dropped = False
+
+'''
+Broker
+Fans the events of this process out to its subscribers
+and keeps a bounded backlog to replay on resumption, in arrival
+order: event ids are drawn when a transaction writes, NOTIFY
+delivers them when it commits, so ids may arrive out of order
+'''
+class Broker:
+    def __init__(self, backlog=EVENTS_BACKLOG):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._backlog = deque(maxlen=backlog)
+
+    def publish(self, event):
+        with self._lock:
+            self._backlog.append(event)
+            subscribers = list(self._subscribers)
+        self._deliver(subscribers, event)
+
+    def _deliver(self, subscribers, event):
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                # a subscriber that cannot keep up is disconnected, it resumes by id
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    '''
+    gap(current_id)
+        events may have been missed (i.e. while the LISTEN connection was
+        down), the backlog is replaced by a resync event, which the
+        subscribers are sent and which a resumption can start after
+    '''
+    def gap(self, current_id):
+        resync = {'id': current_id, 'type': 'resync', 'data': {}}
+        with self._lock:
+            self._backlog.clear()
+            self._backlog.append(resync)
+            subscribers = list(self._subscribers)
+        self._deliver(subscribers, resync)
+
+    '''
+    subscribe(last_id)
+        returns a subscriber, the backlog events that arrived after the
+        event last_id and whether that event is still in the backlog;
+        when it is not, events may have been missed and none are replayed
+    '''
+    def subscribe(self, last_id=None):
+        subscriber = _Subscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if last_id is None:
+                return subscriber, [], True
+            backlog = list(self._backlog)
+        for position in range(len(backlog) - 1, -1, -1):
+            if backlog[position]['id'] == last_id:
+                return subscriber, backlog[position + 1:], True
+        return subscriber, [], False
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+broker = Broker()
+
+'''
+record_event(session, type, data)
+    queues a change event on a session, it is only delivered once the
+    session commits: through NOTIFY on Postgres, in-memory otherwise
+'''
+def record_event(session, type, data):
+    record_events(session, type, [data])
+
+'''
+record_events(session, type, datas)
+    queues one event per data, on Postgres their ids are drawn and
+    their notifications sent by a single statement
+'''
+def record_events(session, type, datas):
+    if not datas:
+        return
+    connection = session.connection(mapper=Player.__mapper__)
+    if connection.dialect.name == 'postgresql':
+        rows = values(column('data', Text), name='events').data([(json.dumps(d),) for d in datas])
+        payload = func.json_build_object(
+            'id', func.nextval('agency_events_id_seq'),
+            'type', type,
+            'data', cast(rows.c.data, JSON)
+        )
+        connection.execute(select(func.pg_notify(EVENTS_CHANNEL, cast(payload, Text))).select_from(rows))
+    else:
+        pending = session.info.setdefault('pending_events', [])
+        pending.extend({'id': None, 'type': type, 'data': data} for data in datas)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _record_player_events(session, flush_context):
+    for instance in session.new:
+        if isinstance(instance, Player):
+            record_event(session, 'player_signed', instance.format())
+
+    for instance in session.dirty:
+        if isinstance(instance, Player):
+            history = inspect(instance).attrs.club_id.history
+            if history.has_changes():
+                data = instance.format()
+                data['from_club_id'] = history.deleted[0] if history.deleted else None
+                record_event(session, 'player_transferred', data)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _publish_pending(session):
+    for pending in session.info.pop('pending_events', []):
+        pending['id'] = _memory_last[0] = next(_memory_ids)
+        broker.publish(pending)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('pending_events', None)
+
+'''
+current_event_id(engine)
+    returns the last event id issued by any process
+'''
+def current_event_id(engine):
+    if engine.dialect.name != 'postgresql':
+        return _memory_last[0]
+    with engine.connect() as connection:
+        return connection.execute(text(
+            'SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM agency_events_id_seq'
+        )).scalar()
+
+'''
+_Listener
+The single LISTEN connection of a process, it publishes
+the notifications of every process to the local broker
+'''
+class _Listener(threading.Thread):
+    def __init__(self, engine):
+        threading.Thread.__init__(self, name='events-listener', daemon=True)
+        self.engine = engine
+        self.ready = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                # the notifications sent until the next LISTEN are lost,
+                # listen() tells the subscribers to resync once it is back
+                self.ready.clear()
+                time.sleep(1)
+
+    def listen(self):
+        connection = self.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN %s' % EVENTS_CHANNEL)
+            broker.gap(current_event_id(self.engine))
+            self.ready.set()
+            while True:
+                if _select.select([dbapi_connection], [], [], EVENTS_HEARTBEAT) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    broker.publish(json.loads(notify.payload))
+        finally:
+            dbapi_connection.close()
+
+_listener_lock = threading.Lock()
+_listener = None
+
+def _ensure_listener(engine):
+    global _listener
+    if engine.dialect.name != 'postgresql':
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = _Listener(engine)
+            _listener.start()
+    if not _listener.ready.wait(EVENTS_LISTEN_TIMEOUT):
+        # no LISTEN connection, notifications would be missed unnoticed
+        raise EventsUnavailable('the change feed is not connected')
+
+'''
+stream(last_event_id)
+    returns a server-sent events response of the change feed,
+    resuming after last_event_id when it is given
+    raises EventsUnavailable when the LISTEN connection is down
+    or EVENTS_MAX_STREAMS streams are open already
+'''
+def stream(last_event_id=None):
+    if not _streams.acquire(blocking=False):
+        metrics.incr('events_streams_refused')
+        raise EventsUnavailable('too many open streams')
+    try:
+        engine = db.get_engine(current_app)
+        _ensure_listener(engine)
+    except BaseException:
+        _streams.release()
+        raise
+    subscriber, replay, complete = broker.subscribe(last_event_id)
+
+    def generate():
+        try:
+            if not complete:
+                # events were missed, the client has to resync with ?since=
+                yield _format({'id': last_event_id, 'type': 'resync', 'data': {}})
+            for e in replay:
+                yield _format(e)
+            while True:
+                try:
+                    e = subscriber.queue.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    if subscriber.dropped:
+                        return
+                    yield ': keepalive\n\n'
+                    continue
+                yield _format(e)
+        finally:
+            broker.unsubscribe(subscriber)
+
+    closed = []
+    def close():
+        # also runs when the client leaves before the stream started
+        if not closed:
+            closed.append(True)
+            broker.unsubscribe(subscriber)
+            _streams.release()
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.call_on_close(close)
+    return response
+
+def _format(e):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (e['id'], e['type'], json.dumps(e['data']))
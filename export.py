@@ -0,0 +1,187 @@
+import csv
+import io
+import os
+import queue
+import threading
+from flask import Response
+from sqlalchemy import text
+
+import metrics
+
+'''
+Export settings
+    EXPORT_CHUNK_SIZE: bytes of CSV sent per chunk
+    EXPORT_BATCH_ROWS: rows fetched per batch by the cursor fallback
+    EXPORT_MAX_STREAMS: exports streamed at once per process, every export
+    holds a server thread (8 per gthread worker, see Procfile), a COPY
+    thread and a database connection, more are refused
+'''
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '65536'))
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '1000'))
+EXPORT_MAX_STREAMS = int(os.getenv('EXPORT_MAX_STREAMS', '2'))
+EXPORT_QUEUE_CHUNKS = 8
+
+_streams = threading.BoundedSemaphore(EXPORT_MAX_STREAMS)
+
+PLAYERS_QUERY = '''
+SELECT players.id AS player_id, players.name AS player_name, players.value,
+       players.club_id, clubs.name AS club_name, clubs.category, clubs.asset
+FROM players LEFT OUTER JOIN clubs ON clubs.id = players.club_id
+ORDER BY players.id
+'''
+PLAYERS_COPY = 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)' % PLAYERS_QUERY.strip()
+
+_DONE = object()
+
+class ExportCancelled(Exception):
+    pass
+
+'''
+ExportUnavailable Exception
+Raised instead of starting an export when EXPORT_MAX_STREAMS are running
+'''
+class ExportUnavailable(Exception):
+    pass
+
+'''
+stream_players_csv(engine)
+    yields the players joined with their clubs as CSV chunks,
+    streamed with COPY on Postgres and a batched cursor otherwise,
+    so memory stays constant whatever the size of the tables
+'''
+def stream_players_csv(engine):
+    if engine.dialect.name == 'postgresql':
+        return _copy_chunks(engine)
+    return _cursor_chunks(engine)
+
+'''
+stream(engine)
+    returns the CSV response of stream_players_csv, holding one of the
+    EXPORT_MAX_STREAMS slots until the response is closed
+    raises ExportUnavailable when none is free
+'''
+def stream(engine):
+    if not _streams.acquire(blocking=False):
+        metrics.incr('export_streams_refused')
+        raise ExportUnavailable('too many running exports')
+
+    closed = []
+    def close():
+        # also runs when the client leaves before the stream started
+        if not closed:
+            closed.append(True)
+            _streams.release()
+
+    try:
+        response = Response(
+            stream_players_csv(engine),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment; filename=players.csv'}
+        )
+    except BaseException:
+        close()
+        raise
+    response.call_on_close(close)
+    return response
+
+'''
+write_players_csv(engine, file)
+    writes the same CSV to a binary file
+'''
+def write_players_csv(engine, file):
+    if engine.dialect.name == 'postgresql':
+        connection = engine.raw_connection()
+        try:
+            connection.cursor().copy_expert(PLAYERS_COPY, file)
+        finally:
+            connection.close()
+        return
+
+    for chunk in _cursor_chunks(engine):
+        file.write(chunk)
+
+'''
+_QueueWriter
+File-like target of COPY TO, hands chunks of at least
+EXPORT_CHUNK_SIZE bytes to the streaming generator
+'''
+class _QueueWriter:
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= EXPORT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        chunk = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        if chunk:
+            self.put(chunk)
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+def _copy_chunks(engine):
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    writer = _QueueWriter(chunks, cancelled)
+
+    def copy():
+        connection = engine.raw_connection()
+        try:
+            connection.cursor().copy_expert(PLAYERS_COPY, writer)
+            writer.flush()
+            writer.put(_DONE)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            try:
+                writer.put(e)
+            except ExportCancelled:
+                pass
+        finally:
+            connection.close()
+
+    threading.Thread(target=copy, name='export-copy', daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # stops the COPY when the client goes away
+        cancelled.set()
+
+def _cursor_chunks(engine):
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(text(PLAYERS_QUERY))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(result.keys())
+
+        while True:
+            rows = result.fetchmany(EXPORT_BATCH_ROWS)
+            if not rows:
+                break
+            writer.writerows(rows)
+            if buffer.tell() >= EXPORT_CHUNK_SIZE:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
@@ -0,0 +1,335 @@
+import codecs
+import csv
+import json
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import insert
+
+from events import record_events
+from models import db, commit, parse_value, Club, Player
+
+'''
+Bulk import settings
+    INGEST_CHUNK_SIZE: records validated per task, payloads of a single
+    chunk are validated in the request thread
+    INGEST_WORKERS: validation processes, shared by the requests of a worker
+    INGEST_MAX_ERRORS: errors reported before an import is abandoned
+    INGEST_MAX_RECORD_BYTES: largest single JSON record accepted
+'''
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '1000'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', str(os.cpu_count() or 1)))
+INGEST_MAX_ERRORS = int(os.getenv('INGEST_MAX_ERRORS', '100'))
+INGEST_MAX_RECORD_BYTES = int(os.getenv('INGEST_MAX_RECORD_BYTES', str(1024 * 1024)))
+INGEST_READ_SIZE = 65536
+
+class MalformedPayload(Exception):
+    pass
+
+'''
+Parsers
+    yield (position, record) one record at a time, reading the
+    payload in INGEST_READ_SIZE blocks; position counts from 0
+'''
+def _read_text(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        while True:
+            data = stream.read(INGEST_READ_SIZE)
+            text = decoder.decode(data or b'', final=not data)
+            if text:
+                yield text
+            if not data:
+                return
+    except UnicodeDecodeError:
+        raise MalformedPayload('payload is not UTF-8')
+
+def iter_json_array(stream):
+    decoder = json.JSONDecoder()
+    chunks = _read_text(stream)
+    buffer, index, eof = '', 0, False
+    # start: before '[', first: after '[', value: after ',', separator: after a value
+    state = 'start'
+    position = 0
+
+    while True:
+        while index < len(buffer) and buffer[index] in ' \t\r\n':
+            index += 1
+        if index == len(buffer):
+            if eof:
+                raise MalformedPayload('unexpected end of the JSON array')
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                buffer, index = buffer[index:] + chunk, 0
+            continue
+
+        char = buffer[index]
+        if state == 'start':
+            if char != '[':
+                raise MalformedPayload('payload is not a JSON array')
+            index += 1
+            state = 'first'
+        elif state == 'separator' or (state == 'first' and char == ']'):
+            if char == ']':
+                return
+            if char != ',':
+                raise MalformedPayload('expected , or ] after record %d' % (position - 1))
+            index += 1
+            state = 'value'
+        else:
+            try:
+                record, end = decoder.raw_decode(buffer, index)
+                # a number may go on in the next block
+                complete = end < len(buffer) or eof
+            except json.JSONDecodeError:
+                complete = False
+            if not complete:
+                if eof or len(buffer) - index > INGEST_MAX_RECORD_BYTES:
+                    raise MalformedPayload('record %d is not valid JSON' % position)
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                else:
+                    buffer, index = buffer[index:] + chunk, 0
+                continue
+            index = end
+            yield position, record
+            position += 1
+            state = 'separator'
+
+def _lines(stream):
+    pending = ''
+    for text in _read_text(stream):
+        *lines, pending = (pending + text).split('\n')
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def iter_csv(stream):
+    reader = csv.DictReader(_lines(stream))
+    try:
+        for position, row in enumerate(reader):
+            yield position, row
+    except csv.Error as e:
+        raise MalformedPayload('line %d: %s' % (reader.line_num, e))
+
+'''
+Schemas
+    field: (required, coerce) of the records of every kind,
+    coerce returns the stored value or raises ValueError
+'''
+def _string(value):
+    if not isinstance(value, str):
+        raise ValueError('must be a string')
+    if not value.strip():
+        raise ValueError('is required')
+    return value.strip()
+
+def _value(value):
+    if isinstance(value, bool):
+        raise ValueError('must be a string or a number')
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        value = str(int(value))
+    elif isinstance(value, float):
+        value = str(value)
+    value = _string(value)
+    if parse_value(value) is None:
+        raise ValueError('has no amount')
+    return value
+
+def _club_id(value):
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise ValueError('must be a club id')
+
+SCHEMAS = {
+    'clubs': {
+        'name': (True, _string),
+        'category': (True, _string),
+        'asset': (True, _string)
+    },
+    'players': {
+        'name': (True, _string),
+        'value': (True, _value),
+        'club_id': (False, _club_id)
+    }
+}
+
+MODELS = {'clubs': Club, 'players': Player}
+
+def _error(position, field, message):
+    return {'position': position, 'field': field, 'message': message}
+
+'''
+validate_chunk(kind, records)
+    checks and coerces a list of (position, record), runs in
+    the validation processes, so it never touches the database
+    returns the valid (position, row) and the errors
+'''
+def validate_chunk(kind, records):
+    schema = SCHEMAS[kind]
+    rows = []
+    errors = []
+    for position, record in records:
+        if not isinstance(record, dict):
+            errors.append(_error(position, None, 'must be an object'))
+            continue
+
+        row = {}
+        failed = False
+        for field in record:
+            if field not in schema:
+                message = 'has more cells than the header' if field is None else 'is not a %s field' % kind[:-1]
+                errors.append(_error(position, field, message))
+                failed = True
+        for field, (required, coerce) in schema.items():
+            value = record.get(field)
+            if value is None or value == '':
+                if required:
+                    errors.append(_error(position, field, 'is required'))
+                    failed = True
+                row[field] = None
+                continue
+            try:
+                row[field] = coerce(value)
+            except ValueError as e:
+                errors.append(_error(position, field, str(e)))
+                failed = True
+
+        if not failed:
+            if kind == 'players':
+                row['value_amount'] = parse_value(row['value'])
+            rows.append((position, row))
+    return rows, errors
+
+_pool_lock = threading.Lock()
+_pool = None
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned, forking a threaded server could copy held locks
+            _pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _chunks(records):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == INGEST_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+'''
+ingest(kind, records)
+@INPUTS
+    kind: 'clubs' or 'players'
+    records: (position, record) as yielded by iter_json_array or iter_csv
+
+validates the records in chunks, across the validation processes when
+there is more than one chunk, checks the club of every player and
+inserts the valid records chunk by chunk in one transaction
+committed only when every record is valid, with a player_signed
+event per imported player
+returns the number of records imported and the errors by position
+'''
+def ingest(kind, records):
+    table = MODELS[kind].__table__
+    state = {'imported': 0, 'errors': [], 'clubs': set()}
+
+    def apply(result):
+        rows, errors = result
+        state['errors'].extend(errors)
+        if kind == 'players':
+            rows = _verify_clubs(rows, state)
+        if rows and not state['errors']:
+            rows = [row for _, row in rows]
+            if kind == 'players':
+                # the Core insert skips the flush events, signings are sent here
+                record_events(db.session(), 'player_signed', _insert_players(rows))
+            else:
+                db.session.execute(insert(table), rows)
+            state['imported'] += len(rows)
+        return len(state['errors']) < INGEST_MAX_ERRORS
+
+    try:
+        chunks = _chunks(records)
+        first = next(chunks, None)
+        second = next(chunks, None) if first is not None else None
+        if second is None:
+            if first is not None:
+                apply(validate_chunk(kind, first))
+        else:
+            pool = _get_pool()
+            pending = deque(pool.submit(validate_chunk, kind, c) for c in (first, second))
+            try:
+                for chunk in chunks:
+                    # bounds the chunks held in memory while the upload is read
+                    while len(pending) >= INGEST_WORKERS * 2:
+                        if not apply(pending.popleft().result()):
+                            break
+                    if len(state['errors']) >= INGEST_MAX_ERRORS:
+                        break
+                    pending.append(pool.submit(validate_chunk, kind, chunk))
+                while pending and len(state['errors']) < INGEST_MAX_ERRORS:
+                    apply(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+    except BaseException:
+        db.session.rollback()
+        raise
+
+    errors = sorted(state['errors'], key=lambda e: e['position'])[:INGEST_MAX_ERRORS]
+    if errors:
+        db.session.rollback()
+        return 0, errors
+    commit()
+    return state['imported'], []
+
+'''
+Inserts a chunk of players, returns them as player_signed data
+    Postgres: one INSERT ... VALUES (...), (...) RETURNING
+    others: one INSERT per player, for its id
+'''
+def _insert_players(rows):
+    players = Player.__table__
+    columns = (players.c.id, players.c.name, players.c.value, players.c.club_id)
+    if db.session.get_bind(mapper=Player.__mapper__).dialect.name == 'postgresql':
+        inserted = db.session.execute(insert(players).values(rows).returning(*columns))
+        return [dict(row._mapping) for row in inserted]
+
+    inserted = []
+    for row in rows:
+        player_id, = db.session.execute(insert(players), row).inserted_primary_key
+        inserted.append({'id': player_id, 'name': row['name'], 'value': row['value'], 'club_id': row['club_id']})
+    return inserted
+
+'''
+Drops the players whose club does not exist, looking up the
+clubs not seen yet with one query per chunk
+'''
+def _verify_clubs(rows, state):
+    known = state['clubs']
+    unseen = set(row['club_id'] for _, row in rows if row['club_id'] is not None) - known
+    if unseen:
+        known.update(club_id for club_id, in db.session.query(Club.id).filter(Club.id.in_(unseen)))
+
+    verified = []
+    for position, row in rows:
+        if row['club_id'] is not None and row['club_id'] not in known:
+            state['errors'].append(_error(position, 'club_id', 'is not an existing club'))
+        else:
+            verified.append((position, row))
+    return verified
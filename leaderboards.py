@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from itertools import chain, groupby
+from sqlalchemy import event, select, true
+
+from models import db, RoutingSession, Club, Player
+
+'''
+Leaderboard settings
+    LEADERBOARD_TTL: seconds a cached leaderboard is served, it is
+    dropped earlier by any write to the clubs or players committed
+    in this process
+    LEADERBOARD_MAX_LIMIT: largest ?limit= accepted
+'''
+LEADERBOARD_TTL = float(os.getenv('LEADERBOARD_TTL', '60'))
+LEADERBOARD_MAX_LIMIT = int(os.getenv('LEADERBOARD_MAX_LIMIT', '100'))
+
+_TABLES = (Club.__tablename__, Player.__tablename__)
+
+_lock = threading.Lock()
+_cache = {}
+_generation = [0]
+
+'''
+most_valuable_players(category, limit)
+    returns the limit most valuable players of every club category,
+    and overall when no category is given, as {name: [players by rank]}
+    an unknown category is not cached, so the cache only holds
+    the existing categories
+'''
+def most_valuable_players(category=None, limit=10):
+    key = (category, limit)
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        generation = _generation[0]
+
+    result = _rank(category, limit)
+    with _lock:
+        # a write committed while ranking has made the result stale
+        if result and generation == _generation[0]:
+            _prune()
+            _cache[key] = (time.monotonic() + LEADERBOARD_TTL, result)
+    return result
+
+def _prune():
+    now = time.monotonic()
+    for key in [key for key, (expires, _) in _cache.items() if expires <= now]:
+        del _cache[key]
+
+def _rank(category, limit):
+    if category is not None:
+        players = _ranked(db.session.execute(_top(limit, category)))
+        return {category: players} if players else {}
+
+    leaderboards = {'overall': _ranked(db.session.execute(_top(limit)))}
+    if db.session.get_bind(mapper=Player.__mapper__).dialect.name == 'postgresql':
+        categories = select(Club.category).where(Club.category.isnot(None)).distinct().subquery('categories')
+        top = _top(limit, categories.c.category).lateral('top')
+        rows = db.session.execute(
+            select(categories.c.category, top).select_from(categories.join(top, true()))
+            .order_by(categories.c.category, top.c.value_amount.desc(), top.c.id)
+        )
+        for category, players in groupby(rows, lambda row: row.category):
+            leaderboards[category] = _ranked(players)
+    else:
+        # no LATERAL, one top-N query per category
+        for category, in db.session.execute(
+                select(Club.category).where(Club.category.isnot(None)).distinct().order_by(Club.category)):
+            players = _ranked(db.session.execute(_top(limit, category)))
+            if players:
+                leaderboards[category] = players
+    return leaderboards
+
+'''
+_top(limit, category)
+    the limit most valuable players, of a club category when given;
+    read in value order from ix_players_value_amount overall and from
+    ix_players_club_id_value_amount for the clubs of a category
+'''
+def _top(limit, category=None):
+    statement = select(
+        Player.id, Player.name, Player.value, Player.value_amount, Player.club_id,
+        Club.name.label('club_name')
+    ).join(Club, Club.id == Player.club_id).where(Player.value_amount.isnot(None))
+    if category is not None:
+        statement = statement.where(Club.category == category)
+    return statement.order_by(Player.value_amount.desc(), Player.id).limit(limit)
+
+def _ranked(rows):
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'value': row.value,
+        'club_id': row.club_id,
+        'club_name': row.club_name,
+        'rank': rank
+    } for rank, row in enumerate(rows, 1)]
+
+'''
+Drops the cached leaderboards once a write to the clubs or
+players is committed, other commits keep them
+'''
+@event.listens_for(RoutingSession, 'after_flush')
+def _track_flush(session, flush_context=None):
+    if any(isinstance(o, (Club, Player)) for o in chain(session.new, session.dirty, session.deleted)):
+        session.info['leaderboards_stale'] = True
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _track_execute(orm_execute_state):
+    statement = orm_execute_state.statement
+    if statement.is_dml and statement.table.name in _TABLES:
+        orm_execute_state.session.info['leaderboards_stale'] = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _invalidate_on_commit(session):
+    if session.info.pop('leaderboards_stale', False):
+        invalidate()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _discard_on_rollback(session):
+    session.info.pop('leaderboards_stale', None)
+
+def invalidate():
+    with _lock:
+        _generation[0] += 1
+        _cache.clear()
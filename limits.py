@@ -0,0 +1,271 @@
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import metrics
+from breaker import CircuitBreaker, CircuitOpenError
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+'''
+Load shedding settings, applied by requires_auth per token subject (sub)
+    RATE_LIMIT: requests per second and burst of a subject ('20/40'),
+    empty or 0 turns it off
+    RATE_LIMIT_PERMISSIONS: stricter rates of a subject on some permissions,
+    i.e. 'post:players=2/10,get:players=50/100'
+    CONCURRENCY_LIMIT: requests of a subject served at once, 0 turns it off
+    RATE_LIMIT_REDIS_URL: Redis shared by the workers, limits are
+    per process when it is not set
+    RATE_LIMIT_REDIS_TIMEOUT: seconds to wait for Redis before falling back
+    to the per process limits
+    CONCURRENCY_LEASE: seconds after which a slot held in Redis by a
+    crashed worker is freed
+'''
+RATE_LIMIT = os.getenv('RATE_LIMIT', '20/40')
+RATE_LIMIT_PERMISSIONS = os.getenv('RATE_LIMIT_PERMISSIONS', '')
+CONCURRENCY_LIMIT = int(os.getenv('CONCURRENCY_LIMIT', '8'))
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+RATE_LIMIT_REDIS_TIMEOUT = float(os.getenv('RATE_LIMIT_REDIS_TIMEOUT', '0.05'))
+CONCURRENCY_LEASE = float(os.getenv('CONCURRENCY_LEASE', '60'))
+RATE_LIMIT_PREFIX = 'agency:limits:'
+# seconds between two sweeps of the refilled per process buckets
+MEMORY_PRUNE_INTERVAL = 10
+
+'''
+LimitExceeded Exception
+Raised when a request is shed, reason is 'rate' or 'concurrency'
+'''
+class LimitExceeded(Exception):
+    def __init__(self, reason, retry_after):
+        Exception.__init__(self, '%s limit exceeded' % reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+'''
+Returns (rate, burst) of 'rate/burst' (or 'rate', the burst being
+the rate), None when the limit is turned off
+'''
+def parse_rate(value):
+    if not value or not value.strip():
+        return None
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1)
+    return (rate, burst) if rate > 0 else None
+
+def parse_permission_rates(value):
+    rates = {}
+    for item in value.split(','):
+        if item.strip():
+            permission, _, rate = item.partition('=')
+            rates[permission.strip()] = parse_rate(rate)
+    return rates
+
+'''
+MemoryBackend
+Token buckets and in-flight counters of this process; a bucket
+refilled to its burst is the same as no bucket, so it is dropped
+'''
+class MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key: (level, at, time at which it is full again)
+        self._buckets = {}
+        self._slots = {}
+        self._next_prune = 0
+
+    '''
+    admit(buckets, slot, now)
+    @INPUTS
+        buckets: list of (key, rate, burst), a token is taken from each
+        slot: (key, limit, slot_id) to hold while the request runs, or None
+
+    takes the tokens and the slot only when all of them are available
+    returns (None, 0) then, (reason, retry_after) otherwise
+    '''
+    def admit(self, buckets, slot, now):
+        with self._lock:
+            self._prune(now)
+            levels = []
+            for key, rate, burst in buckets:
+                level, at, _ = self._buckets.get(key, (burst, now, now))
+                level = min(burst, level + max(0.0, now - at) * rate)
+                if level < 1:
+                    return 'rate', (1 - level) / rate
+                levels.append(level)
+
+            if slot is not None:
+                key, limit, slot_id = slot
+                if self._slots.get(key, 0) >= limit:
+                    return 'concurrency', 1
+                self._slots[key] = self._slots.get(key, 0) + 1
+
+            for (key, rate, burst), level in zip(buckets, levels):
+                self._buckets[key] = (level - 1, now, now + (burst - level + 1) / rate)
+        return None, 0
+
+    def _prune(self, now):
+        if now < self._next_prune:
+            return
+        self._next_prune = now + MEMORY_PRUNE_INTERVAL
+        for key in [key for key, (_, _, full) in self._buckets.items() if full <= now]:
+            del self._buckets[key]
+
+    def release(self, key, slot_id):
+        with self._lock:
+            held = self._slots.get(key, 0) - 1
+            if held > 0:
+                self._slots[key] = held
+            else:
+                self._slots.pop(key, None)
+
+'''
+RedisBackend
+The same buckets and slots in Redis, shared by every worker;
+each admission is one atomic script call
+'''
+_ADMIT_SCRIPT = '''
+local now, limit, lease = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local buckets = #KEYS
+if limit > 0 then buckets = buckets - 1 end
+local levels = {}
+for i = 1, buckets do
+  local rate, burst = tonumber(ARGV[3 + 2 * i]), tonumber(ARGV[4 + 2 * i])
+  local bucket = redis.call('HMGET', KEYS[i], 'level', 'at')
+  local level = tonumber(bucket[1]) or burst
+  local at = tonumber(bucket[2]) or now
+  level = math.min(burst, level + math.max(0, now - at) * rate)
+  if level < 1 then
+    return {'rate', tostring((1 - level) / rate)}
+  end
+  levels[i] = level
+end
+if limit > 0 then
+  local slots = KEYS[#KEYS]
+  redis.call('ZREMRANGEBYSCORE', slots, '-inf', now)
+  if redis.call('ZCARD', slots) >= limit then
+    return {'concurrency', '1'}
+  end
+  redis.call('ZADD', slots, now + lease, ARGV[4])
+  redis.call('EXPIRE', slots, math.ceil(lease))
+end
+for i = 1, buckets do
+  local rate, burst = tonumber(ARGV[3 + 2 * i]), tonumber(ARGV[4 + 2 * i])
+  redis.call('HSET', KEYS[i], 'level', tostring(levels[i] - 1), 'at', tostring(now))
+  redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+end
+return {'ok', '0'}
+'''
+
+class RedisBackend:
+    def __init__(self, client, lease=CONCURRENCY_LEASE):
+        self.client = client
+        self.lease = lease
+        self._admit = client.register_script(_ADMIT_SCRIPT)
+
+    def admit(self, buckets, slot, now):
+        keys = [key for key, _, _ in buckets]
+        args = [now, 0, self.lease, '']
+        if slot is not None:
+            keys.append(slot[0])
+            args[1], args[3] = slot[1], slot[2]
+        for _, rate, burst in buckets:
+            args.extend((rate, burst))
+
+        reason, retry_after = self._admit(keys=keys, args=args)
+        reason = reason.decode() if isinstance(reason, bytes) else reason
+        if reason == 'ok':
+            return None, 0
+        return reason, float(retry_after)
+
+    def release(self, key, slot_id):
+        self.client.zrem(key, slot_id)
+
+'''
+Limiter
+Sheds the requests of a subject over its rate or concurrency limits,
+falls back to the per process limits while the shared backend fails
+'''
+class Limiter:
+    def __init__(self, backend=None, rate=None, permission_rates=None, concurrency=0):
+        self.backend = backend or MemoryBackend()
+        self.rate = rate
+        self.permission_rates = permission_rates or {}
+        self.concurrency = concurrency
+        self.fallback = MemoryBackend()
+        self.breaker = CircuitBreaker('rate_limit', failure_threshold=3, reset_timeout=10)
+
+    '''
+    limit(subject, permission)
+        context manager holding a concurrency slot of the subject,
+        raises LimitExceeded when the request has to be shed
+    '''
+    @contextmanager
+    def limit(self, subject, permission):
+        buckets = []
+        if self.rate is not None:
+            buckets.append((RATE_LIMIT_PREFIX + 'sub:' + subject,) + self.rate)
+        permission_rate = self.permission_rates.get(permission)
+        if permission_rate is not None:
+            buckets.append((RATE_LIMIT_PREFIX + 'permission:%s:%s' % (permission, subject),) + permission_rate)
+        slot = None
+        if self.concurrency > 0:
+            slot = (RATE_LIMIT_PREFIX + 'slots:' + subject, self.concurrency, uuid.uuid4().hex)
+
+        backend = self._admit(buckets, slot)
+        try:
+            yield
+        finally:
+            if slot is not None:
+                self._release(backend, slot)
+
+    def _admit(self, buckets, slot):
+        if not buckets and slot is None:
+            return None
+        now = time.time()
+        backend = self.backend
+        try:
+            if backend is not self.fallback:
+                reason, retry_after = self.breaker.call(backend.admit, buckets, slot, now)
+            else:
+                reason, retry_after = backend.admit(buckets, slot, now)
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError):
+                metrics.incr('rate_limit_backend_errors')
+            backend = self.fallback
+            reason, retry_after = backend.admit(buckets, slot, now)
+
+        if reason is not None:
+            metrics.incr('%s_limited' % reason)
+            raise LimitExceeded(reason, retry_after)
+        return backend
+
+    def _release(self, backend, slot):
+        try:
+            backend.release(slot[0], slot[2])
+        except Exception:
+            # the lease frees the slot
+            metrics.incr('rate_limit_backend_errors')
+
+def _backend():
+    if not RATE_LIMIT_REDIS_URL:
+        return MemoryBackend()
+    if redis is None:
+        raise RuntimeError('RATE_LIMIT_REDIS_URL requires the redis package')
+    return RedisBackend(redis.Redis.from_url(
+        RATE_LIMIT_REDIS_URL,
+        socket_timeout=RATE_LIMIT_REDIS_TIMEOUT,
+        socket_connect_timeout=RATE_LIMIT_REDIS_TIMEOUT
+    ))
+
+limiter = Limiter(
+    _backend(),
+    rate=parse_rate(RATE_LIMIT),
+    permission_rates=parse_permission_rates(RATE_LIMIT_PERMISSIONS),
+    concurrency=CONCURRENCY_LIMIT
+)
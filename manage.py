@@ -1,14 +1,66 @@
+import sys
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
+from app import create_app
+from export import write_players_csv
+import ingest
 from models import db
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
+migrate = Migrate(db=db)
+
+'''
+The application is only built when a command runs, not on import: the
+ingest validation processes spawned by load re-import this script
+'''
+def create_manager_app():
+    app = create_app()
+    migrate.init_app(app)
+    return app
+
+manager = Manager(create_manager_app)
 
 manager.add_command('db', MigrateCommand)
 
+'''
+Exports every player joined with its club as CSV
+    python manage.py export -o players.csv
+'''
+@manager.option('-o', '--output', dest='output', default='-',
+                help='file to write the CSV to, - for stdout')
+def export(output):
+    engine = db.get_engine()
+    if output == '-':
+        write_players_csv(engine, sys.stdout.buffer)
+        return
+    with open(output, 'wb') as file:
+        write_players_csv(engine, file)
+
+'''
+Imports clubs or players from a CSV file (or a JSON array, *.json),
+every record or none
+    python manage.py load players -i players.csv
+'''
+@manager.option('kind', choices=('clubs', 'players'), help='clubs or players')
+@manager.option('-i', '--input', dest='input', default='-',
+                help='file to read the records from, - for stdin (CSV)')
+def load(kind, input):
+    file = sys.stdin.buffer if input == '-' else open(input, 'rb')
+    try:
+        parse = ingest.iter_json_array if input.endswith('.json') else ingest.iter_csv
+        imported, errors = ingest.ingest(kind, parse(file))
+    except ingest.MalformedPayload as e:
+        sys.exit('malformed input: %s' % e)
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+    for error in errors:
+        print('record %(position)d: %(field)s %(message)s' % error, file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    print('imported %d %s' % (imported, kind))
+
 
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
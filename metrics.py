@@ -0,0 +1,40 @@
+import threading
+
+'''
+In-process counters and gauges,
+exposed as JSON on the /metrics endpoint
+'''
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+'''
+incr(name, amount)
+    adds amount to the counter called name
+'''
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+'''
+register_gauge(name, fn)
+    fn is called on every snapshot to read the current value
+'''
+def register_gauge(name, fn):
+    with _lock:
+        _gauges[name] = fn
+
+'''
+Returns the current value of every counter and gauge
+'''
+def snapshot():
+    with _lock:
+        values = dict(_counters)
+        gauges = dict(_gauges)
+    for name, fn in gauges.items():
+        values[name] = fn()
+    return values
+
+def reset():
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,46 @@
+"""add updated_at and tombstones for delta sync
+
+Revision ID: 3f1c9a7d2e58
+Revises: b4a3d3f06e04
+Create Date: 2026-10-19 10:12:40.118207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7d2e58'
+down_revision = 'b4a3d3f06e04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('clubs', 'players'):
+        op.add_column(table, sa.Column('created_at', sa.DateTime(), nullable=False,
+                                       server_default=sa.text("timezone('utc', now())")))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=False,
+                                       server_default=sa.text("timezone('utc', now())")))
+        # the backfill default is only needed for the existing rows
+        op.alter_column(table, 'created_at', server_default=None)
+        op.alter_column(table, 'updated_at', server_default=None)
+        op.create_index(op.f('ix_%s_updated_at' % table), table, ['updated_at'], unique=False)
+
+    op.create_table('tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_tombstones_table_name_deleted_at', 'tombstones', ['table_name', 'deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_table_name_deleted_at', table_name='tombstones')
+    op.drop_table('tombstones')
+    for table in ('players', 'clubs'):
+        op.drop_index(op.f('ix_%s_updated_at' % table), table_name=table)
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'created_at')
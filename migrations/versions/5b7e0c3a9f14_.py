@@ -0,0 +1,71 @@
+"""add parsed player value and leaderboard indexes
+
+Revision ID: 5b7e0c3a9f14
+Revises: 8d4e2b61c0a7
+Create Date: 2026-10-19 16:40:27.118204
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0c3a9f14'
+down_revision = '8d4e2b61c0a7'
+branch_labels = None
+depends_on = None
+
+# players updated per statement by the backfill
+BACKFILL_BATCH = 1000
+
+# models.parse_value as of this revision, copied so that later
+# changes to the parser do not change what this migration wrote
+_VALUE_PATTERN = re.compile(r'(\d[\d,]*(?:\.\d+)?)\s*(thousand|million|billion|bn|k|m|b)?\b', re.IGNORECASE)
+_VALUE_MULTIPLIERS = {
+    'thousand': 10 ** 3, 'k': 10 ** 3,
+    'million': 10 ** 6, 'm': 10 ** 6,
+    'billion': 10 ** 9, 'bn': 10 ** 9, 'b': 10 ** 9
+}
+
+
+def parse_value(value):
+    if value is None:
+        return None
+    match = _VALUE_PATTERN.search(str(value))
+    if match is None:
+        return None
+    amount = float(match.group(1).replace(',', ''))
+    multiplier = _VALUE_MULTIPLIERS.get((match.group(2) or '').lower(), 1)
+    return int(round(amount * multiplier))
+
+
+def upgrade():
+    op.add_column('players', sa.Column('value_amount', sa.BigInteger(), nullable=True))
+
+    connection = op.get_bind()
+    players = sa.table('players', sa.column('id', sa.Integer), sa.column('value_amount', sa.BigInteger))
+    amounts = [(player_id, parse_value(value)) for player_id, value in
+               connection.execute(sa.text('SELECT id, value FROM players'))]
+    amounts = [(player_id, amount) for player_id, amount in amounts if amount is not None]
+    # one UPDATE ... FROM (VALUES ...) per batch
+    for start in range(0, len(amounts), BACKFILL_BATCH):
+        batch = sa.values(sa.column('id', sa.Integer), sa.column('amount', sa.BigInteger), name='amounts') \
+            .data(amounts[start:start + BACKFILL_BATCH])
+        connection.execute(players.update()
+                           .where(players.c.id == batch.c.id)
+                           .values(value_amount=batch.c.amount))
+
+    op.create_index('ix_players_value_amount', 'players', [sa.text('value_amount DESC'), 'id'],
+                    unique=False, postgresql_include=['name', 'value', 'club_id'])
+    op.create_index('ix_players_club_id_value_amount', 'players',
+                    ['club_id', sa.text('value_amount DESC'), 'id'], unique=False)
+    op.create_index('ix_clubs_category', 'clubs', ['category', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_clubs_category', table_name='clubs')
+    op.drop_index('ix_players_club_id_value_amount', table_name='players')
+    op.drop_index('ix_players_value_amount', table_name='players')
+    op.drop_column('players', 'value_amount')
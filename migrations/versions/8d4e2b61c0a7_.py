@@ -0,0 +1,24 @@
+"""add sequence for change feed event ids
+
+Revision ID: 8d4e2b61c0a7
+Revises: 3f1c9a7d2e58
+Create Date: 2026-10-19 14:02:11.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4e2b61c0a7'
+down_revision = '3f1c9a7d2e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('agency_events_id_seq')))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('agency_events_id_seq')))
@@ -0,0 +1,35 @@
+"""add commit-ordered change markers for delta sync
+
+Revision ID: c2d8f4a61e93
+Revises: 5b7e0c3a9f14
+Create Date: 2026-10-19 18:05:52.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d8f4a61e93'
+down_revision = '5b7e0c3a9f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('clubs', 'players', 'tombstones'):
+        op.add_column(table, sa.Column('txid', sa.BigInteger(), nullable=False,
+                                       server_default=sa.text('txid_current()')))
+        # the backfill default is only needed for the existing rows
+        op.alter_column(table, 'txid', server_default=None)
+    for table in ('clubs', 'players'):
+        op.create_index(op.f('ix_%s_txid' % table), table, ['txid'], unique=False)
+    op.create_index('ix_tombstones_table_name_txid', 'tombstones', ['table_name', 'txid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_table_name_txid', table_name='tombstones')
+    for table in ('players', 'clubs'):
+        op.drop_index(op.f('ix_%s_txid' % table), table_name=table)
+    for table in ('tombstones', 'players', 'clubs'):
+        op.drop_column(table, 'txid')
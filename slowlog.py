@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+'''
+Slow query log settings, the log is off unless SLOW_QUERY_MS is set
+    SLOW_QUERY_MS: statements running at least this long are logged
+    SLOW_QUERY_LOG: rotating log file, SLOW_QUERY_LOG_BYTES per file
+    and SLOW_QUERY_LOG_BACKUPS rotated files
+    SLOW_QUERY_EXPLAIN_RATE: share of slow SELECTs whose plan is captured
+    with EXPLAIN (ANALYZE, BUFFERS), re-running them in the background
+    SLOW_QUERY_EXPLAIN_TIMEOUT_MS: statement_timeout of the re-runs
+'''
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '0'))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+SLOW_QUERY_LOG_BYTES = int(os.getenv('SLOW_QUERY_LOG_BYTES', str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', '5000'))
+SLOW_QUERY_EXPLAIN_BACKLOG = 4
+
+logger = logging.getLogger('agency.slow_queries')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+_lock = threading.Lock()
+_settings = {'threshold_ms': 0, 'explain_rate': 0, 'path': None}
+_explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+_explains_pending = [0]
+
+'''
+init_slow_query_log(app)
+    starts logging the statements of every engine that run for at least
+    threshold_ms, a threshold of 0 stops it again
+'''
+def init_slow_query_log(app, threshold_ms=SLOW_QUERY_MS, path=SLOW_QUERY_LOG,
+                        explain_rate=SLOW_QUERY_EXPLAIN_RATE):
+    with _lock:
+        _settings['threshold_ms'] = threshold_ms
+        _settings['explain_rate'] = explain_rate
+        if threshold_ms <= 0 or path == _settings['path']:
+            return
+
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        handler = RotatingFileHandler(path, maxBytes=SLOW_QUERY_LOG_BYTES,
+                                      backupCount=SLOW_QUERY_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        _settings['path'] = path
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _settings['threshold_ms'] > 0:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _handle_error(context):
+    starts = context.connection.info.get('query_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    if elapsed_ms < _settings['threshold_ms']:
+        return
+
+    metrics.incr('slow_queries')
+    record = {
+        'at': datetime.utcnow().isoformat() + 'Z',
+        'ms': round(elapsed_ms, 2),
+        'route': '%s %s' % (request.method, request.url_rule) if has_request_context() else None,
+        'statement': statement,
+        'parameters': _shape(parameters, executemany)
+    }
+
+    if not executemany and _is_explainable(statement) and random.random() < _settings['explain_rate']:
+        with _lock:
+            explain = _explains_pending[0] < SLOW_QUERY_EXPLAIN_BACKLOG
+            if explain:
+                _explains_pending[0] += 1
+        if explain:
+            _explainer.submit(_explain, conn.engine, record, parameters)
+            return
+    logger.info(json.dumps(record))
+
+'''
+Returns the types of the bind parameters, never their values
+'''
+def _shape(parameters, executemany):
+    if executemany:
+        return {'rows': len(parameters), 'row': _shape(parameters[0], False) if parameters else None}
+    if isinstance(parameters, dict):
+        return dict((key, type(value).__name__) for key, value in parameters.items())
+    return [type(value).__name__ for value in parameters or ()]
+
+'''
+Only plain SELECTs are re-run: EXPLAIN ANALYZE executes the statement,
+so one drawing ids, notifying, locking or writing rows is never explained
+'''
+_SIDE_EFFECTS = re.compile(r'\b(nextval|setval|pg_notify)\s*\(|\b(INSERT|UPDATE|DELETE)\b|\bFOR\s+(KEY\s+)?SHARE\b',
+                           re.IGNORECASE)
+
+def _is_explainable(statement):
+    return statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'WITH') \
+        and _SIDE_EFFECTS.search(statement) is None
+
+'''
+Re-runs a slow SELECT under EXPLAIN on its own connection, within
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS, and logs its plan, with the tables
+it scans sequentially
+'''
+def _explain(engine, record, parameters):
+    try:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if engine.dialect.name == 'postgresql':
+                # LOCAL, the rollback resets it before the connection is pooled again
+                cursor.execute('SET LOCAL statement_timeout = %d' % SLOW_QUERY_EXPLAIN_TIMEOUT_MS)
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + record['statement'], parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                record['seq_scans'] = re.findall(r'Seq Scan on (\w+)', plan)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + record['statement'], parameters)
+                plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+                record['seq_scans'] = re.findall(r'\bSCAN (?:TABLE )?(\w+)', plan)
+            record['plan'] = plan
+        finally:
+            connection.rollback()
+            connection.close()
+    except Exception as e:
+        record['plan_error'] = str(e)
+    finally:
+        with _lock:
+            _explains_pending[0] -= 1
+    logger.info(json.dumps(record))
+    if record.get('seq_scans'):
+        metrics.incr('slow_query_seq_scans')
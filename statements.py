@@ -0,0 +1,51 @@
+import os
+import threading
+from sqlalchemy import bindparam, event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+import metrics
+
+'''
+Statement cache settings
+    STATEMENT_CACHE_SIZE: compiled statements kept per engine
+    (SQLAlchemy's query_cache_size)
+'''
+STATEMENT_CACHE_SIZE = int(os.getenv('STATEMENT_CACHE_SIZE', '500'))
+
+_lock = threading.Lock()
+_statements = {}
+
+'''
+cached(key, build)
+    returns the statement stored under key, building it with build()
+    the first time; the statement has to take its values as bind
+    parameters, which are passed when it is executed
+'''
+def cached(key, build):
+    statement = _statements.get(key)
+    if statement is None:
+        with _lock:
+            statement = _statements.get(key)
+            if statement is None:
+                statement = _statements[key] = build()
+    return statement
+
+'''
+by_id(model)
+    returns the lookup of a model row by primary key, executed with
+    {'id': row_id}; it is built once and its compiled form is reused
+'''
+def by_id(model):
+    return cached((model, 'by_id'), lambda: select(model).where(model.id == bindparam('id')))
+
+'''
+Counts the statements served from (and added to) the compiled cache
+'''
+@event.listens_for(Engine, 'after_cursor_execute')
+def _count_cache_hit(conn, cursor, statement, parameters, context, executemany):
+    cache_hit = getattr(context, 'cache_hit', None)
+    if cache_hit is CACHE_HIT:
+        metrics.incr('statement_cache_hits')
+    elif cache_hit is CACHE_MISS:
+        metrics.incr('statement_cache_misses')
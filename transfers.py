@@ -0,0 +1,120 @@
+import os
+from datetime import datetime
+from sqlalchemy import Integer, case, column, update, values
+
+from events import record_events
+from models import db, commit, Club, Player
+
+'''
+Maximum number of moves accepted by a single POST /transfers
+'''
+TRANSFERS_MAX = int(os.getenv('TRANSFERS_MAX', '1000'))
+
+TRANSFERRED = 'transferred'
+UNCHANGED = 'unchanged'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+PLAYER_NOT_FOUND = 'player_not_found'
+CLUB_NOT_FOUND = 'club_not_found'
+
+'''
+transfer_players(moves)
+@INPUTS
+    moves: list of {'player_id': int, 'to_club_id': int}
+
+validates every target club and player with one query each, the players
+locked, moves them with a single UPDATE and notifies the transfers with a
+single statement, in one transaction
+returns the outcome of every move, in order
+'''
+def transfer_players(moves):
+    outcomes = []
+    requested = {}
+    for move in moves:
+        move = move if isinstance(move, dict) else {}
+        player_id, club_id = _ids(move)
+        outcome = {'player_id': move.get('player_id'), 'to_club_id': move.get('to_club_id')}
+        if player_id is None or club_id is None:
+            outcome['status'] = INVALID
+        elif player_id in requested:
+            outcome['status'] = DUPLICATE
+        else:
+            requested[player_id] = club_id
+        outcomes.append(outcome)
+
+    clubs = set()
+    players = {}
+    if requested:
+        clubs = set(club_id for club_id, in db.session.query(Club.id)
+                    .filter(Club.id.in_(set(requested.values()))))
+        # locked until the commit, so the current clubs (from_club_id,
+        # unchanged) cannot change under the UPDATE; in id order against deadlocks
+        players = dict((row.id, row) for row in
+                       db.session.query(Player.id, Player.name, Player.value, Player.club_id)
+                       .filter(Player.id.in_(requested)).order_by(Player.id)
+                       .with_for_update(of=Player))
+
+    applied = {}
+    for outcome in outcomes:
+        if 'status' in outcome:
+            continue
+        player = players.get(outcome['player_id'])
+        if player is None:
+            outcome['status'] = PLAYER_NOT_FOUND
+        elif outcome['to_club_id'] not in clubs:
+            outcome['status'] = CLUB_NOT_FOUND
+        elif player.club_id == outcome['to_club_id']:
+            outcome['status'] = UNCHANGED
+        else:
+            outcome['status'] = TRANSFERRED
+            applied[player.id] = outcome['to_club_id']
+
+    if applied:
+        moved = _apply(applied)
+        transferred = []
+        for outcome in outcomes:
+            if outcome['status'] == TRANSFERRED and outcome['player_id'] not in moved:
+                # deleted since it was validated
+                outcome['status'] = PLAYER_NOT_FOUND
+                continue
+            if outcome['status'] == TRANSFERRED:
+                player = players[outcome['player_id']]
+                transferred.append({
+                    'id': player.id,
+                    'name': player.name,
+                    'value': player.value,
+                    'club_id': outcome['to_club_id'],
+                    'from_club_id': player.club_id
+                })
+        record_events(db.session(), 'player_transferred', transferred)
+    commit()
+    return outcomes
+
+def _ids(move):
+    ids = [move.get('player_id'), move.get('to_club_id')]
+    return tuple(i if isinstance(i, int) and not isinstance(i, bool) else None for i in ids)
+
+'''
+Moves the players in one statement, returns the ids of the players moved
+    Postgres: UPDATE players ... FROM (VALUES ...) RETURNING players.id
+    others: UPDATE players SET club_id = CASE players.id ... END
+'''
+def _apply(applied):
+    players = Player.__table__
+    now = datetime.utcnow()
+    bind = {'mapper': Player.__mapper__}
+
+    if db.session.get_bind(**bind).dialect.name == 'postgresql':
+        moves = values(column('player_id', Integer), column('club_id', Integer), name='moves') \
+            .data(list(applied.items()))
+        statement = update(players) \
+            .where(players.c.id == moves.c.player_id) \
+            .values(club_id=moves.c.club_id, updated_at=now) \
+            .returning(players.c.id)
+        return set(player_id for player_id, in db.session.execute(statement, bind_arguments=bind))
+
+    statement = update(players) \
+        .where(players.c.id.in_(applied)) \
+        .values(club_id=case(applied, value=players.c.id), updated_at=now)
+    db.session.execute(statement, bind_arguments=bind)
+    return set(applied)